@@ -0,0 +1,118 @@
+import datetime
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    # Only the fields are needed, importing diarization would pull in all the models
+    from diarization import Phrase
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meetings (
+    id INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    created TEXT NOT NULL,
+    keywords TEXT,
+    summary TEXT
+);
+CREATE TABLE IF NOT EXISTS phrases (
+    id INTEGER PRIMARY KEY,
+    meeting_id INTEGER NOT NULL REFERENCES meetings(id) ON DELETE CASCADE,
+    speaker TEXT,
+    start REAL,
+    end REAL,
+    text TEXT
+);
+CREATE INDEX IF NOT EXISTS phrases_meeting ON phrases(meeting_id, start);
+CREATE VIRTUAL TABLE IF NOT EXISTS phrases_fts USING fts5(
+    text,
+    content='phrases',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+
+@dataclass
+class SearchHit:
+    meeting_id: int
+    title: str
+    speaker: str
+    start: float
+    end: float
+    snippet: str
+    rank: float
+
+
+class MeetingArchive:
+    """
+    Processed meetings in SQLite, phrases are indexed with FTS5 for ranked full-text search.
+    """
+
+    def __init__(self, path: str = "meetings.sqlite"):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+        # Gradio calls come from worker threads, one connection is shared between them
+        self.lock = threading.Lock()
+
+    def add_meeting(self,
+                    title: str,
+                    phrases: list["Phrase"],
+                    keywords: str = "",
+                    summary: str = "",
+                    created: Optional[str] = None) -> int:
+        with self.lock, self.connection:
+            meeting_id = self.connection.execute(
+                "INSERT INTO meetings (title, created, keywords, summary) VALUES (?, ?, ?, ?)",
+                (title, created or datetime.datetime.now().isoformat(), keywords, summary)).lastrowid
+            self.connection.executemany(
+                "INSERT INTO phrases (meeting_id, speaker, start, end, text) VALUES (?, ?, ?, ?, ?)",
+                ((meeting_id, phrase.speaker, phrase.start, phrase.end, phrase.text) for phrase in phrases))
+            self.connection.execute(
+                # unicode61 does not fold ё into е, both sides of the search are folded by hand
+                "INSERT INTO phrases_fts (rowid, text) "
+                "SELECT id, replace(replace(text, 'ё', 'е'), 'Ё', 'Е') FROM phrases WHERE meeting_id = ?",
+                (meeting_id,))
+        return meeting_id
+
+    def search(self, query: str, limit: int = 20) -> list[SearchHit]:
+        """
+        Phrases matching every word of the query (as a prefix), best bm25 rank first.
+        """
+
+        words = re.findall(r"\w+", query.replace("ё", "е").replace("Ё", "Е"))
+        if len(words) == 0:
+            return []
+        match = " ".join(f'"{word}"*' for word in words)
+
+        # Ranking is cheap, snippets are not: they are built only for the top rows
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                WITH top AS (
+                    SELECT rowid, rank FROM phrases_fts WHERE phrases_fts MATCH :match ORDER BY rank LIMIT :limit
+                )
+                SELECT m.id, m.title, p.speaker, p.start, p.end,
+                       snippet(phrases_fts, 0, '**', '**', '…', 16), top.rank
+                FROM phrases_fts
+                JOIN top ON top.rowid = phrases_fts.rowid
+                JOIN phrases p ON p.id = phrases_fts.rowid
+                JOIN meetings m ON m.id = p.meeting_id
+                WHERE phrases_fts MATCH :match AND phrases_fts.rowid IN (SELECT rowid FROM top)
+                ORDER BY top.rank
+                """, dict(match=match, limit=limit)).fetchall()
+        return [SearchHit(*row) for row in rows]
+
+    def close(self):
+        self.connection.close()
+
+
+def hits_to_markdown(hits: list[SearchHit]) -> str:
+    if len(hits) == 0:
+        return "Ничего не найдено"
+    return "\n".join(f"- **{hit.title}** [{datetime.timedelta(seconds=int(hit.start))} -> "
+                     f"{datetime.timedelta(seconds=int(hit.end))}] {hit.speaker}: {hit.snippet}" for hit in hits)
@@ -0,0 +1,102 @@
+import wave
+from multiprocessing import shared_memory
+from typing import Optional
+
+import numpy as np
+
+
+class SharedAudio:
+    """
+    Mono float32 audio living in a multiprocessing.shared_memory block.
+
+    Every consumer gets a view of the same memory: slicing does not copy, and pickling
+    only sends the block name, so worker processes attach to the block instead of receiving a copy.
+    The creating side owns the block and unlinks it on close().
+    """
+
+    def __init__(self, length: int, sample_rate: int, name: Optional[str] = None):
+        self.length = length
+        self.sample_rate = sample_rate
+        self.owner = name is None
+        size = max(length, 1) * np.dtype(np.float32).itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.samples = np.ndarray((length,), dtype=np.float32, buffer=self.shm.buf)
+
+    @staticmethod
+    def from_wav(path: str) -> "SharedAudio":
+        """
+        Decodes a 16-bit PCM WAV straight into shared memory.
+        The file is memory-mapped, so the only full-size write is the int16 -> float32 conversion.
+        """
+
+        with wave.open(str(path), "rb") as fd:
+            if fd.getsampwidth() != 2 or fd.getnchannels() != 1:
+                raise ValueError(f"{path} is not a mono 16-bit PCM WAV")
+            sample_rate = fd.getframerate()
+            length = fd.getnframes()
+
+        pcm = np.memmap(path, dtype=np.int16, mode="r", offset=_data_offset(path), shape=(length,))
+        result = SharedAudio(length, sample_rate)
+        np.multiply(pcm, 1 / 32768.0, out=result.samples, casting="unsafe")
+        del pcm
+        return result
+
+    @property
+    def duration(self) -> float:
+        return self.length / self.sample_rate
+
+    def view(self, start: float = 0.0, end: Optional[float] = None) -> np.ndarray:
+        """
+        A zero-copy slice of the audio between start and end seconds.
+        """
+
+        start_frame = int(start * self.sample_rate)
+        end_frame = self.length if end is None else min(int(end * self.sample_rate), self.length)
+        return self.samples[start_frame:end_frame]
+
+    def close(self):
+        # The views must go before the buffer can be released
+        self.samples = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Someone still holds a view, the mapping goes away together with it
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+    def __reduce__(self):
+        return SharedAudio, (self.length, self.sample_rate, self.shm.name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def write_wav(path: str, samples: np.ndarray, sample_rate: int):
+    """
+    Writes float samples in [-1, 1] as a mono 16-bit PCM WAV.
+    """
+
+    with wave.open(str(path), "wb") as fd:
+        fd.setnchannels(1)
+        fd.setsampwidth(2)
+        fd.setframerate(sample_rate)
+        fd.writeframes((np.clip(samples, -1, 1) * 32767).astype(np.int16).tobytes())
+
+
+def _data_offset(path: str) -> int:
+    """
+    Position of the PCM samples in a RIFF file; ffmpeg adds a LIST chunk, so this is not always 44.
+    """
+
+    with open(path, "rb") as fd:
+        fd.seek(12)
+        while chunk := fd.read(8):
+            chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:], "little")
+            if chunk_id == b"data":
+                return fd.tell()
+            fd.seek(chunk_size + chunk_size % 2, 1)
+    raise ValueError(f"{path} has no data chunk")
@@ -0,0 +1,281 @@
+import multiprocessing as mp
+import os
+import pickle
+import resource
+import tempfile
+import time
+import tracemalloc
+import wave
+from dataclasses import dataclass
+from pathlib import Path
+from subprocess import run
+from sys import argv
+from typing import Optional
+
+import numpy as np
+
+from audio_buffer import SharedAudio
+from scoring import Segments, score_diarization
+
+SAMPLE_RATE = 16000
+
+
+def write_synthetic_wav(path: Path, minutes: float, chunk_seconds: int = 60):
+    rng = np.random.default_rng(1337)
+    total = int(minutes * 60 * SAMPLE_RATE)
+    with wave.open(str(path), "wb") as fd:
+        fd.setnchannels(1)
+        fd.setsampwidth(2)
+        fd.setframerate(SAMPLE_RATE)
+        for start in range(0, total, chunk_seconds * SAMPLE_RATE):
+            length = min(chunk_seconds * SAMPLE_RATE, total - start)
+            fd.writeframes((rng.standard_normal(length) * 3000).astype(np.int16).tobytes())
+
+
+def run_isolated(target, *args):
+    """
+    Runs target in a fresh process, so that peak RSS belongs to this measurement only.
+    """
+
+    ctx = mp.get_context("spawn")
+    queue = ctx.Queue()
+    process = ctx.Process(target=_isolated, args=(queue, target, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _isolated(queue, target, args):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = target(*args)
+    elapsed = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    queue.put(dict(result, seconds=elapsed, traced_peak_mb=traced_peak / 2 ** 20, peak_rss_mb=peak_rss / 2 ** 10))
+
+
+def _load_legacy(path: str):
+    # What Diarizer.diarize did before SharedAudio, followed by a handoff to a worker process
+    with open(path, "rb") as fd:
+        audio = np.frombuffer(fd.read(), np.int16).flatten()[22:].astype(np.float32) / 32768.0
+    handoff = pickle.dumps(audio)
+    return dict(samples=len(audio), handoff_mb=len(handoff) / 2 ** 20)
+
+
+def _load_shared(path: str):
+    with SharedAudio.from_wav(path) as audio:
+        handoff = pickle.dumps(audio)
+        return dict(samples=audio.length, handoff_mb=len(handoff) / 2 ** 20)
+
+
+def benchmark_audio(minutes: float):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "meeting.wav"
+        write_synthetic_wav(path, minutes)
+        float_mb = minutes * 60 * SAMPLE_RATE * 4 / 2 ** 20
+        print(f"{minutes:.0f} min of audio, {float_mb:.0f} MB as float32")
+        for name, loader in [("legacy", _load_legacy), ("shared", _load_shared)]:
+            result = run_isolated(loader, str(path))
+            # tracemalloc does not see shared memory and mmap, so the copies are counted from the RSS growth
+            print(f"{name:>8}: {result['seconds']:.2f}s, "
+                  f"peak RSS +{result['peak_rss_mb']:.0f} MB ({result['peak_rss_mb'] / float_mb:.1f} float32 copies), "
+                  f"Python heap peak {result['traced_peak_mb']:.0f} MB, "
+                  f"worker handoff {result['handoff_mb']:.3f} MB")
+
+
+def random_segments(rng: np.random.Generator, minutes: float, speakers: int) -> Segments:
+    # Speakers may overlap each other but not themselves, pyannote would count such overlap twice
+    segments = []
+    speaker_end = np.zeros(speakers)
+    time_ = 0.0
+    while time_ < minutes * 60:
+        speaker = rng.integers(speakers)
+        start = max(time_ + rng.exponential(1.0), speaker_end[speaker])
+        end = start + rng.exponential(6.0)
+        segments += [(start, end, f"speaker_{speaker}")]
+        speaker_end[speaker] = end
+        time_ = end - rng.exponential(0.5)
+    return segments
+
+
+def benchmark_scoring(files: int, minutes: float = 10, checked: int = 50):
+    rng = np.random.default_rng(1337)
+    pairs = [(random_segments(rng, minutes, 4), random_segments(rng, minutes, 5)) for _ in range(files)]
+
+    start = time.perf_counter()
+    scores = [score_diarization(reference, hypothesis) for reference, hypothesis in pairs]
+    elapsed = time.perf_counter() - start
+    print(f"Frame scorer: {files} files of {minutes:.0f} min in {elapsed:.2f}s")
+
+    from pyannote.core import Annotation, Segment
+    from pyannote.metrics.diarization import DiarizationErrorRate, JaccardErrorRate
+
+    def to_annotation(segments: Segments) -> Annotation:
+        annotation = Annotation()
+        for segment_start, segment_end, label in segments:
+            annotation[Segment(segment_start, segment_end)] = label
+        return annotation
+
+    der, jer = DiarizationErrorRate(), JaccardErrorRate()
+    start = time.perf_counter()
+    expected = [(der(to_annotation(reference), to_annotation(hypothesis)),
+                 jer(to_annotation(reference), to_annotation(hypothesis)))
+                for reference, hypothesis in pairs[:checked]]
+    elapsed = time.perf_counter() - start
+    print(f"pyannote: {checked} files in {elapsed:.2f}s")
+
+    der_diff = max(abs(score.der - e_der) for score, (e_der, _) in zip(scores, expected))
+    jer_diff = max(abs(score.jer - e_jer) for score, (_, e_jer) in zip(scores, expected))
+    print(f"Max difference from pyannote: DER {der_diff:.4f}, JER {jer_diff:.4f}")
+
+
+def _status_mb(field: str) -> float:
+    with open("/proc/self/status") as fd:
+        for line in fd:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 2 ** 10
+    raise ValueError(f"{field} is not in /proc/self/status")
+
+
+def _diarize_speakers(path: str, block: Optional[float]):
+    import torch
+    from diarization import Diarizer
+
+    # The models and the decoded audio do not depend on the mode, only diarize_speakers is measured
+    diarizer = Diarizer(long_form_block=block)
+    prepared = diarizer.prepare(path)
+    try:
+        # Resets the peak RSS (VmHWM) to the current RSS, the model loading peak is forgotten
+        with open("/proc/self/clear_refs", "w") as fd:
+            fd.write("5")
+        baseline = _status_mb("VmRSS")
+        torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        speakers = diarizer.diarize_speakers(prepared)["speaker"].nunique()
+        return dict(diarize_seconds=time.perf_counter() - start,
+                    diarize_rss_mb=_status_mb("VmHWM") - baseline,
+                    peak_vram_mb=torch.cuda.max_memory_allocated() / 2 ** 20,
+                    speakers=speakers)
+    finally:
+        prepared.close()
+
+
+def benchmark_long_form(audio: str, lengths: list[float], block: float):
+    """
+    Time and memory of NeMo diarization against meeting length, for the whole recording and in blocks.
+    The meeting is made by looping the given audio.
+    """
+
+    print("minutes,mode,diarize_seconds,diarize_rss_mb,peak_vram_mb,speakers")
+    with tempfile.TemporaryDirectory() as tmp:
+        for minutes in lengths:
+            path = Path(tmp) / f"meeting_{minutes:.0f}.wav"
+            run(["ffmpeg", "-loglevel", "error", "-stream_loop", "-1", "-i", audio, "-t", str(minutes * 60),
+                 "-ac", "1", "-ar", str(SAMPLE_RATE), "-y", path]).check_returncode()
+            for mode, mode_block in [("full", None), ("long-form", block)]:
+                result = run_isolated(_diarize_speakers, str(path), mode_block)
+                print(f"{minutes:.0f},{mode},{result['diarize_seconds']:.1f},{result['diarize_rss_mb']:.0f},"
+                      f"{result['peak_vram_mb']:.0f},{result['speakers']}", flush=True)
+
+
+@dataclass
+class _Phrase:
+    start: float
+    end: float
+    text: str
+    speaker: str
+
+
+def benchmark_archive(meetings: int, phrases_per_meeting: int = 300, queries: int = 200):
+    from archive import MeetingArchive
+
+    rng = np.random.default_rng(1337)
+    letters = list("абвгдеёжзийклмнопрстуфхцчшщыэюя")
+    vocabulary = np.array(list(dict.fromkeys("".join(rng.choice(letters, size=rng.integers(3, 10)))
+                                             for _ in range(20000))))
+    # Zipf-like word frequencies, like real speech
+    weights = 1 / np.arange(1, len(vocabulary) + 1)
+    weights /= weights.sum()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = MeetingArchive(str(Path(tmp) / "meetings.sqlite"))
+
+        start = time.perf_counter()
+        for meeting in range(meetings):
+            words = rng.choice(vocabulary, size=(phrases_per_meeting, 15), p=weights)
+            phrases = [_Phrase(i * 5.0, i * 5.0 + 4.5, " ".join(text), f"Speaker {i % 4}")
+                       for i, text in enumerate(words)]
+            archive.add_meeting(f"meeting_{meeting}", phrases, "", "")
+        elapsed = time.perf_counter() - start
+        print(f"Inserted {meetings} meetings, {meetings * phrases_per_meeting} phrases in {elapsed:.1f}s "
+              f"({elapsed / meetings * 1000:.1f} ms per meeting)")
+
+        for name, query_words in [("frequent", vocabulary[:50]), ("rare", vocabulary[5000:]),
+                                  ("two words", vocabulary[:2000])]:
+            words = rng.choice(query_words, size=(queries, 2 if name == "two words" else 1))
+            start = time.perf_counter()
+            for query in words:
+                archive.search(" ".join(query))
+            elapsed = time.perf_counter() - start
+            print(f"{name:>10} queries: {elapsed / queries * 1000:.2f} ms each")
+
+        archive.close()
+
+
+def _export_protocol(out_dir: str, hours: float):
+    from protocol import ProtocolExporter
+
+    rng = np.random.default_rng(1337)
+    letters = list("абвгдеёжзийклмнопрстуфхцчшщыэюя")
+    vocabulary = ["".join(rng.choice(letters, size=rng.integers(3, 10))) for _ in range(5000)]
+    phrases = []
+    time_ = 0.0
+    while time_ < hours * 3600:
+        duration = rng.exponential(8.0) + 1
+        phrases += [_Phrase(time_, time_ + duration, " ".join(rng.choice(vocabulary, size=int(duration * 2.5))),
+                            f"Speaker {rng.integers(6)}")]
+        time_ += duration + rng.exponential(0.5)
+    summary = "\n".join(" ".join(rng.choice(vocabulary, size=20)) for _ in range(10))
+    keywords = "\n".join(f"{i + 1}. {word}" for i, word in enumerate(rng.choice(vocabulary, size=30)))
+
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    paths = ProtocolExporter(out_dir).submit("protocol", phrases, keywords, summary).result()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    return dict(phrases=len(phrases), export_seconds=elapsed, export_peak_mb=peak / 2 ** 20,
+                sizes_mb=[os.path.getsize(path) / 2 ** 20 for path in paths])
+
+
+def benchmark_export(hours: float):
+    with tempfile.TemporaryDirectory() as tmp:
+        result = run_isolated(_export_protocol, tmp, hours)
+    docx_mb, txt_mb = result["sizes_mb"]
+    print(f"{hours:.0f} h transcript, {result['phrases']} phrases: exported in {result['export_seconds']:.2f}s, "
+          f"heap peak during export {result['export_peak_mb']:.1f} MB, "
+          f".docx {docx_mb:.1f} MB, .txt {txt_mb:.1f} MB")
+
+
+def main():
+    match argv[1]:
+        case "audio":
+            benchmark_audio(float(argv[2]) if len(argv) > 2 else 180)
+        case "scoring":
+            benchmark_scoring(int(argv[2]) if len(argv) > 2 else 1000)
+        case "longform":
+            benchmark_long_form(argv[2], [float(m) for m in argv[3:]] or [15, 30, 60, 120, 180],
+                                float(os.environ.get("LONG_FORM_BLOCK_SECONDS", "600")))
+        case "archive":
+            benchmark_archive(int(argv[2]) if len(argv) > 2 else 2000)
+        case "export":
+            benchmark_export(float(argv[2]) if len(argv) > 2 else 4)
+        case _:
+            raise RuntimeError(f"{argv[1]} is not supported.")
+
+
+if __name__ == "__main__":
+    main()
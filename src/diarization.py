@@ -14,14 +14,22 @@ from tqdm import tqdm
 from dataclasses import dataclass
 import math
 from omegaconf import OmegaConf
-from nemo.collections.asr.models import NeuralDiarizer
+from nemo.collections.asr.models import NeuralDiarizer, EncDecSpeakerLabelModel
 import pandas as pd
 from datetime import timedelta
 from subprocess import run
+from collections import Counter, defaultdict
 import re
+import shutil
+import tempfile
 import numpy as np
 from pyannote.core import Annotation, Segment, SlidingWindowFeature, SlidingWindow
 
+from audio_buffer import SharedAudio, write_wav
+from longform import block_bounds, link_speakers, merge_touching
+from pipeline import BatchPipeline
+from residency import ResidencyScheduler
+
 
 @dataclass
 class Phrase:
@@ -125,6 +133,82 @@ def to_whisperx_aligned_transcript(result):
     return {"segments": segments, "word_segments": word_segments}
 
 
+def low_confidence_spans(segments: list[dict], threshold: float, max_gap: float = 1.0) -> list[tuple[int, int]]:
+    """
+    Finds runs of whisper_timestamped segments that contain a word with confidence below threshold.
+    :param segments: segments with words and their confidence
+    :param threshold: words below it are considered unreliable
+    :param max_gap: flagged segments closer than this are re-decoded together
+    :return: (first, last) segment indices of every run, inclusive
+    """
+
+    spans = []
+    for index, segment in enumerate(segments):
+        if not any(word["confidence"] < threshold for word in segment.get("words", [])):
+            continue
+        if spans and spans[-1][1] == index - 1 and segment["start"] - segments[index - 1]["end"] <= max_gap:
+            spans[-1] = (spans[-1][0], index)
+        else:
+            spans += [(index, index)]
+    return spans
+
+
+def shift_segments(segments: list[dict], offset: float) -> list[dict]:
+    result = []
+    for segment in segments:
+        words = [dict(word, start=word["start"] + offset, end=word["end"] + offset)
+                 for word in segment.get("words", [])]
+        result += [dict(segment, start=segment["start"] + offset, end=segment["end"] + offset, words=words)]
+    return result
+
+
+def union_duration(intervals: list[tuple[float, float]]) -> float:
+    """
+    Total length covered by the intervals, overlapping parts are counted once.
+    """
+
+    total = 0.0
+    covered = -math.inf
+    for start, end in sorted(intervals):
+        if end > covered:
+            total += end - max(start, covered)
+            covered = end
+    return total
+
+
+def test_low_confidence_spans():
+    def segment(start, end, *confidences):
+        return {"start": start, "end": end, "words": [{"confidence": c} for c in confidences]}
+
+    segments = [segment(0, 1, 0.9, 0.2), segment(1.5, 2, 0.3), segment(5, 6, 0.9), segment(7, 8, 0.1),
+                segment(10, 11, 0.4)]
+    assert low_confidence_spans(segments, 0.5) == [(0, 1), (3, 3), (4, 4)]
+    assert union_duration([(0, 2), (1, 3), (5, 6), (5.5, 5.7)]) == 4
+
+
+@dataclass
+class PreparedAudio:
+    source: Path
+    # Unique NeMo session name, files with the same basename may be prepared while another one is diarized
+    name: str
+    work_dir: str
+    wav_file: str
+    manifest_file: str
+    buffer: SharedAudio
+
+    @property
+    def audio(self) -> np.ndarray:
+        return self.buffer.samples
+
+    @property
+    def duration(self) -> float:
+        return self.buffer.duration
+
+    def close(self):
+        self.buffer.close()
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
 class Diarizer:
     def __init__(self,
                  # Maybe try dvislobokov/whisper-large-v3-turbo-russian later
@@ -137,20 +221,50 @@ class Diarizer:
                  beam_size: Optional[int] = None,
                  dtype: str = "float32",
                  batch_size: int = 1,
-                 minimize_vram_usage: bool = int(os.environ.get("MINIMIZE_VRAM_USAGE", "0")) != 0):
+                 minimize_vram_usage: bool = int(os.environ.get("MINIMIZE_VRAM_USAGE", "0")) != 0,
+                 vram_budget: Optional[float] = float(os.environ["VRAM_BUDGET_GB"]) if "VRAM_BUDGET_GB" in os.environ
+                 else None,
+                 draft_arch: Optional[str] = os.environ.get("DRAFT_WHISPER_ARCH"),
+                 escalation_threshold: float = 0.5,
+                 long_form_block: Optional[float] = float(os.environ["LONG_FORM_BLOCK_SECONDS"])
+                 if "LONG_FORM_BLOCK_SECONDS" in os.environ else None,
+                 long_form_threshold: float = 0.5,
+                 long_form_embedding_seconds: float = 60.0):
+        """
+        :param minimize_vram_usage: keep at most one model on the GPU, same as vram_budget=0
+        :param vram_budget: how many GB of model weights may stay on the GPU, unlimited by default
+        :param draft_arch: a small whisper that transcribes everything first, only the segments with a word
+        less confident than escalation_threshold are then re-decoded by whisper_arch.
+        Only supported with timestamped alignment.
+        :param long_form_block: recordings longer than this many seconds are diarized in blocks of it,
+        and block speakers are linked by their embeddings (cosine similarity above long_form_threshold)
+        """
+
+        if draft_arch is not None and alignment != "timestamped":
+            raise ValueError("Draft transcription requires timestamped alignment")
+
         self.config = OmegaConf.load(model_config)
         self.diarizer = NeuralDiarizer(self.config).eval()
 
         self.alignment = alignment
         self.whisper_arch = whisper_arch
 
-        parking_device = "cpu" if minimize_vram_usage else "cuda"
+        if vram_budget is None:
+            vram_budget = 0 if minimize_vram_usage else math.inf
+        parking_device = "cpu" if vram_budget != math.inf else "cuda"
+        self.residency = ResidencyScheduler(vram_budget * 2 ** 30, device="cuda", parking_device="cpu")
+        self.residency.register("diarizer", self.diarizer)
 
         match alignment:
             case "timestamped":
                 self.transcriber = td.load_model(whisper_arch, device=parking_device, in_memory=True).eval()
+                self.residency.register("transcriber", self.transcriber)
+                if draft_arch is not None:
+                    self.draft_transcriber = td.load_model(draft_arch, device=parking_device, in_memory=True).eval()
+                    self.residency.register("draft_transcriber", self.draft_transcriber)
             case "whisperx":
                 self.aligner, self.meta = wx.load_align_model(language_code, parking_device)
+                self.residency.register("aligner", self.aligner)
 
         self.input_manifest_file = input_manifest_file
         self.language_code = language_code
@@ -161,28 +275,25 @@ class Diarizer:
         self.dtype = dtype
         self.batch_size = batch_size
         self.minimize_vram_usage = minimize_vram_usage
-
-    def clean_run(self, model, runnable):
-        """
-        Enables machines with very low VRAM to run this script.
-        :param model: the model to upload to CUDA
-        :param runnable: the action to perform on model
-        :return: the result of runnable
-        """
-
-        if self.minimize_vram_usage:
-            model.to("cuda")
-            result = runnable(model)
-            model.to("cpu")
-            gc.collect()
-            torch.cuda.empty_cache()
-        else:
-            result = runnable(model)
-        print(torch.cuda.memory_summary())
-        return result
-
-    def prepare_audio(self, audio_file: Path):
-        out_file = audio_file.name + ".wav"
+        self.draft_arch = draft_arch
+        self.escalation_threshold = escalation_threshold
+        self.escalated_seconds = 0.0
+        self.transcribed_seconds = 0.0
+        self.long_form_block = long_form_block
+        self.long_form_threshold = long_form_threshold
+        self.long_form_embedding_seconds = long_form_embedding_seconds
+        if long_form_block is not None:
+            # Block speakers are linked by embeddings of their own speech, outside of NeMo's diarization
+            self.speaker_model = EncDecSpeakerLabelModel.from_pretrained(
+                self.config.diarizer.speaker_embeddings.model_path, map_location="cpu").eval()
+            self.residency.register("speaker_model", self.speaker_model)
+
+    @property
+    def escalated_fraction(self) -> float:
+        return self.escalated_seconds / self.transcribed_seconds if self.transcribed_seconds > 0 else 0.0
+
+    def prepare_audio(self, audio_file: Path, manifest_file: Optional[str] = None, out_file: Optional[str] = None):
+        out_file = out_file or audio_file.name + ".wav"
 
         run(["ffmpeg",
              "-i", audio_file,
@@ -200,12 +311,34 @@ class Diarizer:
             'duration': None,
             'rttm_filepath': None
         }
-        with open(self.input_manifest_file, "w") as file:
+        with open(manifest_file or self.input_manifest_file, "w") as file:
             json.dump(meta, file)
             file.write("\n")
 
         return out_file
 
+    def prepare(self, audio: str) -> PreparedAudio:
+        """
+        Decodes the audio and writes the NeMo manifest, i.e. everything that does not need the models.
+        The files go to a temporary directory of their own, removed by PreparedAudio.close.
+        :param audio: path to the source audio
+        :return: the decoded audio ready for diarize_prepared
+        """
+
+        source_audio = Path(audio)
+        work_dir = tempfile.mkdtemp(prefix="diarize-")
+        # NeMo names the session (and its RTTM) after the WAV basename
+        name = f"{Path(work_dir).name}.{source_audio.name}"
+        manifest_file = os.path.join(work_dir, "manifest.json")
+        try:
+            wav_audio = self.prepare_audio(source_audio, manifest_file, os.path.join(work_dir, name + ".wav"))
+            buffer = SharedAudio.from_wav(wav_audio)
+        except BaseException:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            raise
+
+        return PreparedAudio(source_audio, name, work_dir, wav_audio, manifest_file, buffer)
+
     def load_vad_frame(self, filename):
         with open(filename) as fd:
             lines = [float(line) for line in fd.readlines()]
@@ -213,35 +346,162 @@ class Diarizer:
         window = self.config.diarizer.vad.parameters.window_length_in_sec
         return SlidingWindowFeature(np.array(lines).reshape((-1, 1)), SlidingWindow(window, step))
 
-    def diarize(self, audio: str, annotation: Optional[Annotation] = None) -> tuple[Annotation, list[Phrase]]:
-        with torch.no_grad():
-            source_audio = Path(audio)
-            wav_audio = self.prepare_audio(source_audio)
+    def transcribe_cascaded(self, audio: np.ndarray, voice: list[tuple[float, float]], options: dict) -> dict:
+        """
+        Transcribes with the draft model, then re-decodes low-confidence spans with the large one
+        and splices them back with their timestamps shifted to the span start.
+        """
+
+        draft = self.residency.run("draft_transcriber",
+                                   lambda t: td.transcribe_timestamped(t, audio, vad=voice, **options),
+                                   prefetch="transcriber")
+        segments = draft["segments"]
+        spans = low_confidence_spans(segments, self.escalation_threshold)
+
+        result = []
+        previous = 0
+        for first, last in spans:
+            start, end = segments[first]["start"], segments[last]["end"]
+            piece = audio[int(start * self.sample_rate):int(end * self.sample_rate)]
+            redone = self.residency.run("transcriber", lambda t: td.transcribe_timestamped(t, piece, **options))
+            result += segments[previous:first] + shift_segments(redone["segments"], start)
+            previous = last + 1
+        result += segments[previous:]
+
+        # The large model decodes whole spans, gaps included; overlapping speech is counted once
+        escalated = union_duration([(segments[first]["start"], segments[last]["end"]) for first, last in spans])
+        voiced = union_duration(voice)
+        self.escalated_seconds += escalated
+        self.transcribed_seconds += voiced
+        print(f"Escalated {len(spans)} spans, {escalated:.1f}s of {voiced:.1f}s to {self.whisper_arch}")
+
+        return dict(draft, segments=result)
+
+    def diarize_speakers(self, prepared: PreparedAudio, annotation: Optional[Annotation] = None) -> pd.DataFrame:
+        rttm = Path("pred_rttms") / (prepared.name + ".rttm")
+
+        if annotation is not None:
+            with open(rttm, "w") as fd:
+                annotation.write_rttm(fd)
+        elif self.long_form_block is not None and prepared.duration > 1.5 * self.long_form_block:
+            self.diarize_long_form(prepared, rttm)
+        else:
+            self.run_nemo(prepared.manifest_file, prefetch=self.first_asr_stage())
+
+        diarization = load_diarization(rttm)
+        # The session name is unique, the file would only pile up
+        rttm.unlink()
+        return diarization
+
+    def run_nemo(self, manifest_file: str, prefetch: Optional[str] = None):
+        """
+        Runs NeMo on the given manifest. NeuralDiarizer copies diarizer.manifest_filepath into the MSDD test_ds
+        config once at construction, and both clustering and MSDD read that copy, so it is the one to update
+        (NeuralDiarizer.__call__ does the same).
+        """
+
+        def diarize(diarizer: NeuralDiarizer):
+            self.config.diarizer.manifest_filepath = manifest_file
+            diarizer.msdd_model.cfg.test_ds.manifest_filepath = manifest_file
+            return diarizer.diarize()
+
+        self.residency.run("diarizer", diarize, prefetch=prefetch)
 
-            with open(wav_audio, "rb") as fd:
-                audio = np.frombuffer(fd.read(), np.int16).flatten()[22:].astype(np.float32) / 32768.0
-                print(audio.max())
+    def first_asr_stage(self) -> str:
+        if self.alignment == "whisperx":
+            return "aligner"
+        return "draft_transcriber" if self.draft_arch is not None else "transcriber"
 
-            if annotation is not None:
-                with open(Path("pred_rttms") / (source_audio.name + ".rttm"), "w") as fd:
-                    annotation.write_rttm(fd)
-            else:
-                self.clean_run(self.diarizer, lambda d: d.diarize())
+    def diarize_long_form(self, prepared: PreparedAudio, rttm: Path):
+        """
+        Diarizes fixed-size blocks as separate NeMo sessions, so clustering cost grows linearly with duration,
+        then links speakers across blocks by clustering their centroid embeddings and writes one RTTM.
+        """
+
+        blocks = block_bounds(prepared.duration, self.long_form_block)
+        names = [f"{prepared.name}.block{index:03d}" for index in range(len(blocks))]
+
+        # The block WAVs are only needed by NeMo, they are as large as the recording itself
+        with tempfile.TemporaryDirectory(prefix="blocks-") as block_dir:
+            with open(prepared.manifest_file, "w") as file:
+                for name, (start, end) in zip(names, blocks):
+                    block_wav = os.path.join(block_dir, name + ".wav")
+                    write_wav(block_wav, prepared.buffer.view(start, end), self.sample_rate)
+                    json.dump({'audio_filepath': block_wav, 'offset': 0, 'label': 'infer', 'duration': None,
+                               'rttm_filepath': None}, file)
+                    file.write("\n")
+
+            # One manifest with all blocks: NeMo extracts their embeddings in shared batches but clusters them apart
+            self.run_nemo(prepared.manifest_file, prefetch="speaker_model")
+
+        segments = []
+        embeddings = []
+        keys = []
+        limit = int(self.long_form_embedding_seconds * self.sample_rate)
+        for index, (name, (offset, _)) in enumerate(zip(names, blocks)):
+            block_rttm = Path("pred_rttms") / (name + ".rttm")
+            if not block_rttm.exists():
+                # A block without speech, e.g. a break, may get no RTTM at all
+                continue
+            block = load_diarization(block_rttm)
+            block_rttm.unlink()
+            for speaker, rows in block.groupby("speaker"):
+                samples = np.concatenate([prepared.buffer.view(offset + row.start, offset + row.end)
+                                          for row in rows.itertuples()])[:limit]
+                embedding = self.residency.run("speaker_model", lambda m: m.infer_segment(samples)[0])
+                embeddings += [embedding.squeeze(0).float().cpu().numpy()]
+                keys += [(index, speaker)]
+                segments += [(offset + row.start, offset + row.end, (index, speaker)) for row in rows.itertuples()]
+
+        if len(embeddings) > 0:
+            labels = link_speakers(np.stack(embeddings), np.array([index for index, _ in keys]),
+                                   self.long_form_threshold)
+        else:
+            labels = np.zeros(0, dtype=int)
+        global_speaker = {key: f"speaker_{label}" for key, label in zip(keys, labels)}
+        linked = merge_touching([(start, end, global_speaker[key]) for start, end, key in segments])
+
+        with open(rttm, "w") as fd:
+            for start, end, speaker in linked:
+                fd.write(f"SPEAKER {prepared.source.name} 1 {start:.3f} {end - start:.3f} "
+                         f"<NA> <NA> {speaker} <NA> <NA>\n")
+
+        print(f"Long-form diarization: {len(blocks)} blocks, {len(embeddings)} block speakers, "
+              f"{len(set(labels))} speakers")
+
+    def diarize(self, audio: str, annotation: Optional[Annotation] = None) -> tuple[Annotation, list[Phrase]]:
+        prepared = self.prepare(audio)
+        try:
+            return self.diarize_prepared(prepared, annotation)
+        finally:
+            prepared.close()
+
+    def diarize_prepared(self, prepared: PreparedAudio,
+                         annotation: Optional[Annotation] = None) -> tuple[Annotation, list[Phrase]]:
+        with torch.no_grad():
+            source_audio = prepared.source
+            audio = prepared.audio
 
-            diarization = load_diarization(Path("pred_rttms") / (source_audio.name + ".rttm"))
+            diarization = self.diarize_speakers(prepared, annotation)
 
             match self.alignment:
                 case "timestamped":
                     voice = list(diarization[["start", "end"]].itertuples(index=False, name=None))
                     options = dict(language=self.language_code, beam_size=self.beam_size)
-                    result = self.clean_run(self.transcriber,
-                                            lambda t: td.transcribe_timestamped(t, audio, vad=voice, **options))
+                    if self.draft_arch is not None:
+                        result = self.transcribe_cascaded(audio, voice, options)
+                    else:
+                        result = self.residency.run("transcriber",
+                                                    lambda t: td.transcribe_timestamped(t, audio, vad=voice,
+                                                                                        **options))
                     aligned_transcript = to_whisperx_aligned_transcript(result)
                 case "whisperx":
                     options = dict(language=self.language_code)
                     # vad_frame = self.load_vad_frame(Path("vad_outputs") / (source_audio.name + ".frame"))
                     # vad_params = dict(vad_onset=self.config.diarizer.vad.parameters.onset,
                     #                   vad_offset=self.config.diarizer.vad.parameters.offset)
+                    # The whisperx model is not managed by the scheduler, the idle ones have to make room for it
+                    self.residency.evict_idle()
                     transcriber = wx.load_model(self.whisper_arch,
                                                 device="cuda",
                                                 compute_type=self.dtype,
@@ -254,9 +514,9 @@ class Diarizer:
                     gc.collect()
                     torch.cuda.empty_cache()
                     print(torch.cuda.memory_summary())
-                    aligned_transcript = self.clean_run(self.aligner,
-                                                        lambda t: wx.align(result["segments"], t, self.meta, audio,
-                                                                           "cuda"))
+                    aligned_transcript = self.residency.run("aligner",
+                                                            lambda t: wx.align(result["segments"], t, self.meta,
+                                                                               audio, "cuda"))
 
         result = wx.assign_word_speakers(diarization, aligned_transcript, fill_nearest=False)
 
@@ -354,25 +614,53 @@ def label_studio_json_to_phrases(path) -> dict[str, tuple[list[Phrase], float]]:
     return result
 
 
-def main():
-    infiles = argv[1:]
-    bar = tqdm(infiles)
-    diarizer = Diarizer()
-    for infile in bar:
-        data = {}
-        bar.set_postfix(current_file=infile)
+@dataclass
+class BatchItem:
+    audio: str
+    key: str
+    outfile: str
+    annotation: Optional[Annotation] = None
+
+
+def batch_items(infiles: list[str]) -> list[BatchItem]:
+    items = []
+    for infile in infiles:
         if infile.endswith(".json"):
             for path, (annotation, orig_len) in labal_studio_json_to_annotation(infile).items():
-                print("Loaded annotation")
-                _, segments = diarizer.diarize(str(Path(infile).parent / path), annotation=annotation)
-                data[path] = segments
-            outfile = infile[:-5] + ".new.json"
+                items += [BatchItem(str(Path(infile).parent / path), path, infile[:-5] + ".new.json", annotation)]
         else:
-            outfile = infile + ".json"
-            annotation, segments = diarizer.diarize(infile)
-            data[infile] = segments
-        with open(outfile, "w") as out:
-            out.write(phrases_to_label_studio_json(data))
+            items += [BatchItem(infile, infile, infile + ".json")]
+    return items
+
+
+def main():
+    items = batch_items(argv[1:])
+    remaining = Counter(item.outfile for item in items)
+    data = defaultdict(dict)
+    diarizer = Diarizer()
+    bar = tqdm(total=len(items))
+
+    def process(item: BatchItem, prepared: PreparedAudio) -> list[Phrase]:
+        _, segments = diarizer.diarize_prepared(prepared, annotation=item.annotation)
+        bar.update()
+        return segments
+
+    def export(item: BatchItem, segments: list[Phrase]):
+        data[item.outfile][item.key] = segments
+        remaining[item.outfile] -= 1
+        if remaining[item.outfile] == 0:
+            with open(item.outfile, "w") as out:
+                out.write(phrases_to_label_studio_json(data.pop(item.outfile)))
+
+    pipeline = BatchPipeline(lambda item: diarizer.prepare(item.audio), process, export,
+                             duration=lambda prepared: prepared.duration,
+                             release=lambda prepared: prepared.close())
+    stats = pipeline.run(items, on_item=lambda item: bar.set_postfix(current_file=item.audio))
+    bar.close()
+    print(stats)
+    print(diarizer.residency.report())
+    if diarizer.draft_arch is not None:
+        print(f"Escalated {diarizer.escalated_fraction:.1%} of speech to {diarizer.whisper_arch}")
 
 
 if __name__ == "__main__":
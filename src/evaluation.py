@@ -4,18 +4,18 @@ import jiwer
 
 from diarization import Diarizer, label_studio_json_to_phrases, Phrase, phrases_to_markdown
 import glob
-from pyannote.metrics.diarization import JaccardErrorRate, DiarizationErrorRate
-from pyannote.core import Annotation, Segment
-from jiwer import wer
+from pyannote.core import Annotation
+from scoring import Segments, score_diarization
 from pathlib import Path
 from tqdm.autonotebook import tqdm
 
 
-def phrases_to_annotation(phrases: list[Phrase]) -> Annotation:
-    result = Annotation()
-    for phrase in phrases:
-        result[Segment(phrase.start, phrase.end)] = phrase.speaker
-    return result
+def phrases_to_segments(phrases: list[Phrase]) -> Segments:
+    return [(phrase.start, phrase.end, phrase.speaker) for phrase in phrases]
+
+
+def annotation_to_segments(annotation: Annotation) -> Segments:
+    return [(segment.start, segment.end, label) for segment, _, label in annotation.itertracks(yield_label=True)]
 
 
 def concat_phrases(phrases: list[Phrase]) -> str:
@@ -38,42 +38,43 @@ def evaluate_diarization(root: str):
     for file in tqdm(to_evaluate.keys()):
         results[file] = diarizer.diarize(file)
 
-    jer = JaccardErrorRate()
-    der = DiarizationErrorRate()
-    der_no_miss = DiarizationErrorRate(miss=0.0)
+    tr = jiwer.Compose([
+        jiwer.RemoveMultipleSpaces(),
+        jiwer.RemovePunctuation(),
+        jiwer.ToLowerCase(),
+        jiwer.ReduceToListOfListOfWords()
+    ])
 
     total_jer = 0
     total_der = 0
     total_der_no_miss = 0
+    word_errors = 0
+    reference_words = 0
 
     total_length = sum(l for _, l in to_evaluate.values())
 
-    for (expected, length), (got_annotation, got) in zip(*[to_evaluate.values(), (results[k] for k in to_evaluate.keys())]):
-        expected_annotation = phrases_to_annotation(expected)
-
-        total_jer += jer(expected_annotation, got_annotation) * length / total_length
-        total_der += der(expected_annotation, got_annotation) * length / total_length
-        total_der_no_miss += der_no_miss(expected_annotation, got_annotation) * length / total_length
-
-    print("JER", total_jer)
-    print("DER", total_der)
-    print("DER no miss", total_der)
+    for file, (expected, length) in to_evaluate.items():
+        got_annotation, got = results[file]
+        score = score_diarization(phrases_to_segments(expected), annotation_to_segments(got_annotation))
 
-    expected_text = [concat_phrases(phrases) for phrases, _ in to_evaluate.values()]
-    got_text = [concat_phrases(results[k][1]) for k in to_evaluate.keys()]
+        total_jer += score.jer * length / total_length
+        total_der += score.der * length / total_length
+        total_der_no_miss += score.error_rate(miss=0.0) * length / total_length
 
-    for md1, md2 in zip(expected_text, got_text):
-        print(md1)
-        print(md2)
+        expected_text, got_text = concat_phrases(expected), concat_phrases(got)
+        print(expected_text)
+        print(got_text)
 
-    tr = jiwer.Compose([
-        jiwer.RemoveMultipleSpaces(),
-        jiwer.RemovePunctuation(),
-        jiwer.ToLowerCase(),
-        jiwer.ReduceToListOfListOfWords()
-    ])
-    print("WER", wer(expected_text, got_text, reference_transform=tr, hypothesis_transform=tr))
+        words = jiwer.process_words(expected_text, got_text, reference_transform=tr, hypothesis_transform=tr)
+        errors = words.substitutions + words.deletions + words.insertions
+        word_errors += errors
+        reference_words += words.substitutions + words.deletions + words.hits
+        print(f"{file}: DER {score.der:.3f}, JER {score.jer:.3f}, WER {words.wer:.3f}")
 
+    print("JER", total_jer)
+    print("DER", total_der)
+    print("DER no miss", total_der_no_miss)
+    print("WER", word_errors / reference_words if reference_words > 0 else 0.0)
 
 
 def main():
@@ -1,12 +1,14 @@
 import json
 import os
 import random
+from functools import lru_cache
 from pathlib import Path
 
 import pandas as pd
 import torch
 import torchaudio
-import torchaudio.functional as audio_func
+import torchaudio.transforms as audio_transforms
+import soundfile
 from pyannote.audio import Pipeline
 import numpy as np
 
@@ -47,10 +49,47 @@ initial_params = {"onset": 0.4, "offset": 0.3, "min_duration_on": 0.0, "min_dura
 vad.instantiate(initial_params)
 
 
+@lru_cache(maxsize=None)
+def get_resampler(source_sample_rate, target_sample_rate):
+    """
+    Common Voice clips share one sample rate, so the resampling kernel is built once per rate pair.
+    """
+    return audio_transforms.Resample(source_sample_rate, target_sample_rate)
+
+
 def load_audio(file, target_sample_rate=default_sample_rate, **kwargs):
     tensor, sample_rate = torchaudio.load(file)
-    tensor /= tensor.abs().max()
-    return audio_func.resample(tensor, sample_rate, target_sample_rate)
+    tensor.div_(tensor.abs().max())
+    with torch.no_grad():
+        return get_resampler(sample_rate, target_sample_rate)(tensor)
+
+
+class StreamingWavWriter:
+    """
+    Appends clips to a WAV file as they come, so memory does not grow with the number of clips.
+    Samples are written as float32, like torchaudio.save did for the concatenated tensor.
+    """
+
+    def __init__(self, path, sample_rate=default_sample_rate):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.file = None
+
+    def write(self, tensor):
+        if self.file is None:
+            self.file = soundfile.SoundFile(self.path, "w", samplerate=self.sample_rate,
+                                            channels=tensor.size(0), subtype="FLOAT")
+        self.file.write(tensor.T.numpy())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def measure_sample(tensor, sample_rate=default_sample_rate):
@@ -63,26 +102,24 @@ def measure_sample(tensor, sample_rate=default_sample_rate):
 
 
 def concat_and_save(index, samples):
-    audios = []
     metas = []
     prev_end = 0
 
-    for idx, row in samples.iterrows():
-        audio = load_audio(clips_path / row["path"])
-        timings = measure_sample(audio.to(device))
-        if timings is None:
-            print(f"{index} has no voice detected. Skipping")
-            continue
-        audios += [audio]
-        metas += [(row["client_id"][:6], row["sentence"], timings[0] + prev_end / default_sample_rate,
-                   timings[1] + prev_end / default_sample_rate)]
-        prev_end += audio.size(1)
-
-    concat_audio = torch.concat(audios, 1)
     rel_path = f"clips/{index}.wav"
     abs_path = output_path / rel_path
     abs_path.parent.mkdir(parents=True, exist_ok=True)
-    torchaudio.save(abs_path, concat_audio, default_sample_rate)
+
+    with StreamingWavWriter(abs_path, default_sample_rate) as writer:
+        for idx, row in samples.iterrows():
+            audio = load_audio(clips_path / row["path"])
+            timings = measure_sample(audio.to(device))
+            if timings is None:
+                print(f"{index} has no voice detected. Skipping")
+                continue
+            writer.write(audio)
+            metas += [(row["client_id"][:6], row["sentence"], timings[0] + prev_end / default_sample_rate,
+                       timings[1] + prev_end / default_sample_rate)]
+            prev_end += audio.size(1)
 
     result = []
     for id, (speaker, text, start, end) in enumerate(metas):
@@ -0,0 +1,76 @@
+import numpy as np
+
+Segments = list[tuple[float, float, str]]
+
+
+def block_bounds(duration: float, block: float) -> list[tuple[float, float]]:
+    """
+    Splits [0, duration] into blocks of the given length, a short tail is attached to the last block.
+    """
+
+    count = max(1, int(round(duration / block)))
+    edges = [i * block for i in range(count)] + [duration]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def link_speakers(embeddings: np.ndarray, blocks: np.ndarray, threshold: float) -> np.ndarray:
+    """
+    Average-linkage agglomerative clustering of block speakers by cosine similarity.
+    Two speakers of the same block were already told apart by the diarizer, so they never end up together.
+    :param embeddings: (speakers, dim) centroid embedding of every block speaker
+    :param blocks: (speakers,) block index of every block speaker
+    :param threshold: clusters less similar than this stay apart
+    :return: (speakers,) global speaker index
+    """
+
+    normalized = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    similarity = normalized @ normalized.T
+    membership = np.eye(len(embeddings))
+    occupied = np.zeros((len(embeddings), blocks.max() + 1 if len(blocks) > 0 else 0), dtype=bool)
+    occupied[np.arange(len(blocks)), blocks] = True
+    alive = np.ones(len(embeddings), dtype=bool)
+
+    while alive.sum() > 1:
+        sizes = membership.sum(axis=1)
+        linkage = membership @ similarity @ membership.T / np.maximum(np.outer(sizes, sizes), 1)
+        conflict = (occupied.astype(int) @ occupied.T.astype(int)) > 0
+        linkage[conflict | ~alive[:, None] | ~alive[None, :]] = -np.inf
+        first, second = np.unravel_index(np.argmax(linkage), linkage.shape)
+        if linkage[first, second] < threshold:
+            break
+        membership[first] += membership[second]
+        membership[second] = 0
+        occupied[first] |= occupied[second]
+        occupied[second] = False
+        alive[second] = False
+
+    _, labels = np.unique(membership.argmax(axis=0), return_inverse=True)
+    return labels
+
+
+def merge_touching(segments: Segments, tolerance: float = 0.05) -> Segments:
+    """
+    Joins segments of one speaker that were cut at a block boundary.
+    """
+
+    result = []
+    last_of = {}
+    for start, end, label in sorted(segments):
+        previous = last_of.get(label)
+        if previous is not None and start - result[previous][1] <= tolerance:
+            result[previous] = (result[previous][0], max(end, result[previous][1]), label)
+        else:
+            last_of[label] = len(result)
+            result += [(start, end, label)]
+    return result
+
+
+def test_link_speakers():
+    embeddings = np.array([[1, 0], [0, 1], [0.9, 0.1], [0.1, 0.9], [0.95, 0.05]])
+    blocks = np.array([0, 0, 1, 1, 1])
+    labels = link_speakers(embeddings, blocks, threshold=0.8)
+    # 2 and 4 are both close to 0, but they talk in the same block, so the closer one wins
+    assert labels[0] == labels[4] and labels[1] == labels[3]
+    assert labels[0] != labels[1] and labels[2] not in (labels[0], labels[1])
+    assert block_bounds(25, 10) == [(0, 10), (10, 25)]
+    assert merge_touching([(0, 10, "a"), (10, 12, "a"), (11, 13, "b")]) == [(0, 12, "a"), (11, 13, "b")]
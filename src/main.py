@@ -1,16 +1,22 @@
 import datetime
+import os
 import shutil
 import gradio as gr
+import archive
 import diarization
+import protocol
 import summarize
+from concurrent.futures import Future
+from pathlib import Path
 from typing import Optional
 
 
-def handle_audio(audio_record: Optional[str], audio_upload: Optional[str], progress=gr.Progress()) -> tuple[str, str, str]:
+def handle_audio(audio_record: Optional[str], audio_upload: Optional[str],
+                 progress=gr.Progress()) -> tuple[str, str, str, Optional[Future]]:
     audio_path = audio_upload if audio_upload else audio_record
 
     if audio_path is None:
-        return "Аудио не загружено", "Аудио не загружено", "Аудио не загружено"
+        return "Аудио не загружено", "Аудио не загружено", "Аудио не загружено", None
 
     timestamp = datetime.datetime.now().isoformat()
     new_path = f"recorded_{timestamp}"
@@ -32,12 +38,30 @@ def handle_audio(audio_record: Optional[str], audio_upload: Optional[str], progr
 
     summary = summarizer.summarize(md)
 
+    meetings.add_meeting(new_path, phrases, keywords, summary)
+
+    # The protocol is written in the background, its future goes to the session state for wait_protocol,
+    # so it is dropped together with the session even if wait_protocol never runs
+    export = exporter.submit(Path(new_path).stem, diarization.join_phrases(phrases), keywords, summary)
+
     progress(1.0, "✅ Анализ завершен!")
 
-    return md, keywords, summary
+    return md, keywords, summary, export
+
+
+def wait_protocol(export: Optional[Future]) -> Optional[list[str]]:
+    if export is None:
+        return None
+    return export.result()
+
+
+def handle_search(query: str) -> str:
+    return archive.hits_to_markdown(meetings.search(query))
 
 
 diarizer = diarization.Diarizer()
+meetings = archive.MeetingArchive(os.environ.get("MEETING_ARCHIVE", "meetings.sqlite"))
+exporter = protocol.ProtocolExporter(os.environ.get("PROTOCOL_DIR", "protocols"))
 
 EXTRACT_PROMPT = """Выпиши из приведеного текста уникальные ключевые сущности (даты, события, места, имена и так далее) и их контекст, а также общую категорию этого слова.
 Например, для текста "Встречу по разработке нового интерфейса для интернет-магазина переносим на следующую неделю." ответ будет:
@@ -52,8 +76,10 @@ EXTRACT_PROMPT = """Выпиши из приведеного текста уни
 Выведи каждое слово с большой буквы. Выписывай нужное слово и его контекст, если понадобится.
 Избегай повторений!"""
 
-summarizer = summarize.Summarizer()
-extractor = summarize.Summarizer(system_prompt=EXTRACT_PROMPT)
+# One backend for both, so its prompt cache keeps the two system prompts
+summary_backend = summarize.make_backend()
+summarizer = summarize.Summarizer(backend=summary_backend)
+extractor = summarize.Summarizer(system_prompt=EXTRACT_PROMPT, backend=summary_backend)
 
 custom_css = """
 :root {
@@ -144,6 +170,13 @@ with gr.Blocks(title="Аудио Анализатор", theme=gr.themes.Soft(),
 
             progress_bar = gr.HTML(visible=False)
 
+            protocol_files = gr.File(
+                label="Протокол (.docx, .txt)",
+                file_count="multiple",
+                interactive=False
+            )
+            protocol_state = gr.State()
+
         with gr.Column(scale=2, elem_classes="output-container"):
             with gr.Tabs():
                 with gr.Tab("📜 Полный текст", elem_classes="tab-button"):
@@ -167,6 +200,15 @@ with gr.Blocks(title="Аудио Анализатор", theme=gr.themes.Soft(),
                         interactive=False,
                         elem_classes="textbox"
                     )
+                with gr.Tab("🔎 Поиск по встречам", elem_classes="tab-button"):
+                    with gr.Row():
+                        search_input = gr.Textbox(
+                            label="Что искать",
+                            placeholder="Например: бюджет",
+                            scale=4
+                        )
+                        search_btn = gr.Button("Найти", variant="primary", scale=1)
+                    search_output = gr.Markdown()
 
 
     def show_progress():
@@ -187,15 +229,23 @@ with gr.Blocks(title="Аудио Анализатор", theme=gr.themes.Soft(),
     ).then(
         handle_audio,
         inputs=[audio_input, file_input],  # Теперь передаем оба источника как отдельные входы
-        outputs=[transcript_output, phrases_output, summary_output],
+        outputs=[transcript_output, phrases_output, summary_output, protocol_state],
     ).then(
         lambda: gr.HTML(visible=False),
         outputs=progress_bar
+    ).then(
+        wait_protocol,
+        inputs=protocol_state,
+        outputs=protocol_files
     )
 
+    search_btn.click(handle_search, inputs=search_input, outputs=search_output)
+    search_input.submit(handle_search, inputs=search_input, outputs=search_output)
+
     clear_btn.click(
-        lambda: [None, None, "", "", "", gr.HTML(visible=False)],
-        outputs=[audio_input, file_input, transcript_output, phrases_output, summary_output, progress_bar]
+        lambda: [None, None, "", "", "", gr.HTML(visible=False), None],
+        outputs=[audio_input, file_input, transcript_output, phrases_output, summary_output, progress_bar,
+                 protocol_files]
     )
 
 if __name__ == "__main__":
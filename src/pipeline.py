@@ -0,0 +1,199 @@
+import threading
+import time
+from dataclasses import dataclass, field
+from queue import Queue, Full, Empty
+from typing import Any, Callable, Iterable, Optional
+
+_DONE = object()
+
+
+@dataclass
+class PipelineStats:
+    files: int = 0
+    audio_seconds: float = 0.0
+    wall_seconds: float = 0.0
+    stage_seconds: dict[str, float] = field(default_factory=lambda: {"prepare": 0.0, "process": 0.0, "export": 0.0})
+
+    @property
+    def audio_hours_per_hour(self) -> float:
+        return self.audio_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0
+
+    def __str__(self):
+        stages = ", ".join(f"{name} {seconds:.1f}s" for name, seconds in self.stage_seconds.items())
+        return (f"{self.files} files, {self.audio_seconds / 3600:.2f} h of audio in {self.wall_seconds:.1f}s "
+                f"({self.audio_hours_per_hour:.2f} audio-hours per hour; {stages})")
+
+
+class _StageThread(threading.Thread):
+    def __init__(self, name: str, target: Callable[[], None]):
+        super().__init__(name=name, daemon=True)
+        self._target_fn = target
+        self.error: Optional[BaseException] = None
+
+    def run(self):
+        try:
+            self._target_fn()
+        except BaseException as e:
+            self.error = e
+
+
+class BatchPipeline:
+    """
+    Runs prepare -> process -> export over many items with bounded queues between the stages,
+    so that decoding of the next file and writing of the previous one overlap with model inference.
+
+    prepare(item) runs on a background thread and returns whatever process needs,
+    process(item, prepared) runs on the calling thread (the models stay where they were created),
+    export(item, processed) runs on another background thread.
+    """
+
+    def __init__(self,
+                 prepare: Callable[[Any], Any],
+                 process: Callable[[Any, Any], Any],
+                 export: Callable[[Any, Any], None],
+                 duration: Callable[[Any], float] = lambda prepared: 0.0,
+                 release: Callable[[Any], None] = lambda prepared: None,
+                 prefetch: int = 1,
+                 export_backlog: int = 4):
+        self.prepare = prepare
+        self.process = process
+        self.export = export
+        self.duration = duration
+        self.release = release
+        self.prefetch = prefetch
+        self.export_backlog = export_backlog
+
+    def run(self, items: Iterable[Any], on_item: Callable[[Any], None] = lambda item: None) -> PipelineStats:
+        stats = PipelineStats()
+        prepared_queue = Queue(maxsize=self.prefetch)
+        export_queue = Queue(maxsize=self.export_backlog)
+        stop = threading.Event()
+
+        def put(queue: Queue, value) -> bool:
+            # Gives up if the consumer died, so that the producer does not block forever
+            while not stop.is_set():
+                try:
+                    queue.put(value, timeout=0.1)
+                    return True
+                except Full:
+                    continue
+            return False
+
+        def get(queue: Queue):
+            while not stop.is_set():
+                try:
+                    return queue.get(timeout=0.1)
+                except Empty:
+                    continue
+            return _DONE
+
+        def prepare_loop():
+            try:
+                for item in items:
+                    if stop.is_set():
+                        break
+                    start = time.perf_counter()
+                    prepared = self.prepare(item)
+                    stats.stage_seconds["prepare"] += time.perf_counter() - start
+                    if not put(prepared_queue, (item, prepared)):
+                        # Nobody will process it, and _drain will not see it either
+                        self.release(prepared)
+            finally:
+                put(prepared_queue, _DONE)
+
+        def export_loop():
+            try:
+                while (entry := export_queue.get()) is not _DONE:
+                    item, processed = entry
+                    start = time.perf_counter()
+                    self.export(item, processed)
+                    stats.stage_seconds["export"] += time.perf_counter() - start
+            except BaseException:
+                stop.set()
+                raise
+
+        preparer = _StageThread("prepare", prepare_loop)
+        exporter = _StageThread("export", export_loop)
+
+        wall_start = time.perf_counter()
+        preparer.start()
+        exporter.start()
+
+        try:
+            while (entry := get(prepared_queue)) is not _DONE:
+                item, prepared = entry
+                on_item(item)
+                start = time.perf_counter()
+                try:
+                    processed = self.process(item, prepared)
+                    stats.audio_seconds += self.duration(prepared)
+                finally:
+                    self.release(prepared)
+                stats.stage_seconds["process"] += time.perf_counter() - start
+                stats.files += 1
+                put(export_queue, (item, processed))
+        finally:
+            put(export_queue, _DONE)
+            stop.set()
+            preparer.join()
+            exporter.join()
+            self._drain(prepared_queue)
+
+        stats.wall_seconds = time.perf_counter() - wall_start
+
+        for thread in (preparer, exporter):
+            if thread.error is not None:
+                raise thread.error
+
+        return stats
+
+    def _drain(self, queue: Queue):
+        while True:
+            try:
+                entry = queue.get_nowait()
+            except Empty:
+                return
+            if entry is not _DONE:
+                self.release(entry[1])
+
+
+def test_batch_pipeline():
+    prepared_items, released = [], []
+
+    def prepare(item):
+        prepared_items.append(item)
+        return item
+
+    def pipeline(fail_process=None, fail_export=None):
+        exported = []
+
+        def process(item, prepared):
+            if item == fail_process:
+                raise ValueError(item)
+            return prepared * 10
+
+        def export(item, processed):
+            if item == fail_export:
+                raise ValueError(item)
+            exported.append((item, processed))
+
+        return BatchPipeline(prepare, process, export, duration=lambda prepared: 1.0,
+                             release=released.append, prefetch=2, export_backlog=1), exported
+
+    batch, exported = pipeline()
+    stats = batch.run(range(10))
+    assert exported == [(i, i * 10) for i in range(10)]
+    assert sorted(released) == list(range(10))
+    assert stats.files == 10 and stats.audio_seconds == 10.0
+
+    for failure in [dict(fail_process=2), dict(fail_export=2)]:
+        prepared_items.clear()
+        released.clear()
+        batch, _ = pipeline(**failure)
+        try:
+            batch.run(range(10))
+            raise AssertionError("the stage error was swallowed")
+        except ValueError as e:
+            assert e.args == (2,)
+        # Everything that was prepared is released exactly once
+        assert sorted(released) == sorted(prepared_items)
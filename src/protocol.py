@@ -0,0 +1,164 @@
+import re
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+from typing import Iterable, Optional, TYPE_CHECKING
+from xml.sax.saxutils import escape
+
+if TYPE_CHECKING:
+    from diarization import Phrase
+
+TITLE = "Протокол совещания"
+
+CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" \
+ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" \
+ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+PACKAGE_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" \
+Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" \
+Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal"><w:name w:val="Normal"/>
+<w:pPr><w:spacing w:after="120"/></w:pPr><w:rPr><w:sz w:val="22"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Title"><w:name w:val="Title"/><w:basedOn w:val="Normal"/>
+<w:rPr><w:b/><w:sz w:val="36"/></w:rPr></w:style>
+<w:style w:type="paragraph" w:styleId="Heading1"><w:name w:val="heading 1"/><w:basedOn w:val="Normal"/>
+<w:pPr><w:keepNext/><w:spacing w:before="240"/><w:outlineLvl w:val="0"/></w:pPr>
+<w:rPr><w:b/><w:sz w:val="28"/></w:rPr></w:style>
+</w:styles>"""
+
+DOCUMENT_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>"""
+
+DOCUMENT_END = """<w:sectPr/></w:body></w:document>"""
+
+# Characters XML 1.0 does not allow even escaped
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def format_time(seconds: float) -> str:
+    return str(timedelta(seconds=int(seconds)))
+
+
+def transcript_lines(phrases: Iterable["Phrase"]) -> Iterable[tuple[str, str]]:
+    for phrase in phrases:
+        yield f"[{format_time(phrase.start)} -> {format_time(phrase.end)}] {phrase.speaker}", phrase.text
+
+
+def write_txt(path: Path, phrases: Iterable["Phrase"], keywords: str, summary: str, title: str = TITLE):
+    """
+    Writes the protocol as plain text, line by line.
+    """
+
+    with open(path, "w", encoding="utf-8") as fd:
+        fd.write(f"{title}\n\nКраткое содержание\n{summary.strip()}\n\nКлючевые слова\n{keywords.strip()}\n\n"
+                 f"Стенограмма\n")
+        for header, text in transcript_lines(phrases):
+            fd.write(f"{header}: {text}\n")
+
+
+def _paragraph(fd: "_TextWriter", text: str, style: Optional[str] = None, bold_prefix: Optional[str] = None):
+    properties = f'<w:pPr><w:pStyle w:val="{style}"/></w:pPr>' if style else ""
+    runs = f'<w:r><w:rPr><w:b/></w:rPr><w:t xml:space="preserve">{_xml(bold_prefix)}</w:t></w:r>' \
+        if bold_prefix else ""
+    runs += f'<w:r><w:t xml:space="preserve">{_xml(text)}</w:t></w:r>'
+    fd.write(f"<w:p>{properties}{runs}</w:p>")
+
+
+def _xml(text: str) -> str:
+    return escape(_INVALID_XML.sub("", text))
+
+
+def write_docx(path: Path, phrases: Iterable["Phrase"], keywords: str, summary: str, title: str = TITLE):
+    """
+    Writes the protocol as .docx. The document part is streamed into the zip entry paragraph by paragraph,
+    so memory does not depend on the transcript length.
+    """
+
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", CONTENT_TYPES)
+        archive.writestr("_rels/.rels", PACKAGE_RELS)
+        archive.writestr("word/_rels/document.xml.rels", DOCUMENT_RELS)
+        archive.writestr("word/styles.xml", STYLES)
+
+        with archive.open("word/document.xml", "w", force_zip64=True) as raw, \
+                _TextWriter(raw) as fd:
+            fd.write(DOCUMENT_START)
+            _paragraph(fd, title, "Title")
+            _paragraph(fd, "Краткое содержание", "Heading1")
+            for line in summary.strip().splitlines():
+                _paragraph(fd, line)
+            _paragraph(fd, "Ключевые слова", "Heading1")
+            for line in keywords.strip().splitlines():
+                _paragraph(fd, line)
+            _paragraph(fd, "Стенограмма", "Heading1")
+            for header, text in transcript_lines(phrases):
+                _paragraph(fd, text, bold_prefix=header + ": ")
+            fd.write(DOCUMENT_END)
+
+
+class _TextWriter:
+    """
+    Buffers small writes into large UTF-8 chunks for the compressed zip stream.
+    """
+
+    def __init__(self, raw, chunk_size: int = 1 << 16):
+        self.raw = raw
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, text: str):
+        self.parts += [text]
+        self.size += len(text)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        self.raw.write("".join(self.parts).encode("utf-8"))
+        self.parts = []
+        self.size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+
+class ProtocolExporter:
+    """
+    Writes .docx and .txt protocols on a background thread, the interactive response does not wait for them.
+    """
+
+    def __init__(self, out_dir: str = "protocols", max_workers: int = 1):
+        self.out_dir = Path(out_dir)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="protocol")
+
+    def export(self, name: str, phrases: list["Phrase"], keywords: str, summary: str) -> list[str]:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        docx_path = self.out_dir / f"{name}.docx"
+        txt_path = self.out_dir / f"{name}.txt"
+        write_docx(docx_path, phrases, keywords, summary)
+        write_txt(txt_path, phrases, keywords, summary)
+        return [str(docx_path), str(txt_path)]
+
+    def submit(self, name: str, phrases: list["Phrase"], keywords: str, summary: str) -> Future:
+        return self.executor.submit(self.export, name, phrases, keywords, summary)
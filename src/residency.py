@@ -0,0 +1,190 @@
+import gc
+import math
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Optional, TypeVar
+
+import torch
+
+T = TypeVar("T")
+
+
+@dataclass
+class ResidencyStats:
+    footprint: int
+    uses: int = 0
+    loads: int = 0
+    evictions: int = 0
+    prefetches: int = 0
+    transfer_seconds: float = 0.0
+
+
+def model_footprint(model: torch.nn.Module) -> int:
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+class ResidencyScheduler:
+    """
+    Decides which models stay on the GPU.
+
+    Every model has a footprint (its weights), and the resident ones must fit into the budget.
+    A model is uploaded when it is needed or prefetched, and the coldest idle models (fewest uses,
+    then least recently used) are parked back only when the budget would be exceeded.
+    """
+
+    def __init__(self, budget: float = math.inf, device: str = "cuda", parking_device: str = "cpu"):
+        self.budget = budget
+        self.device = torch.device(device)
+        self.parking_device = torch.device(parking_device)
+
+        self.models: dict[str, torch.nn.Module] = {}
+        self.stats: dict[str, ResidencyStats] = {}
+        self.resident: set[str] = set()
+        self.last_used: dict[str, int] = {}
+        self.busy: dict[str, int] = {}
+        self.clock = 0
+
+        self.lock = threading.RLock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self.pending: dict[str, Future] = {}
+        self.stream = torch.cuda.Stream() if self.device.type == "cuda" and torch.cuda.is_available() else None
+
+    def register(self, name: str, model: torch.nn.Module, footprint: Optional[int] = None):
+        with self.lock:
+            self.models[name] = model
+            self.stats[name] = ResidencyStats(footprint if footprint is not None else model_footprint(model))
+            self.last_used[name] = 0
+            self.busy[name] = 0
+            if self._device_of(model) == self.device.type:
+                self.resident.add(name)
+
+    def run(self, name: str, runnable: Callable[[torch.nn.Module], T], prefetch: Optional[str] = None) -> T:
+        """
+        Runs runnable on the model once it is on the GPU; the model cannot be evicted meanwhile.
+        :param prefetch: the model of the next stage, uploaded in the background while runnable works
+        """
+
+        self._wait_prefetch(name)
+        with self.lock:
+            self._make_resident(name, self.stats[name].footprint)
+            self.busy[name] += 1
+            self.clock += 1
+            self.last_used[name] = self.clock
+            self.stats[name].uses += 1
+        try:
+            if prefetch is not None:
+                self.prefetch(prefetch)
+            return runnable(self.models[name])
+        finally:
+            with self.lock:
+                self.busy[name] -= 1
+
+    def prefetch(self, name: str):
+        """
+        Starts uploading the model in the background if it fits into the free budget, prefetching never evicts.
+        """
+
+        with self.lock:
+            if name in self.resident or name in self.pending:
+                return
+            if self._used() + self.stats[name].footprint > self.budget:
+                return
+            # Reserved right away: the model counts against the budget and cannot be evicted while it moves
+            self.resident.add(name)
+            self.busy[name] += 1
+            self.pending[name] = self.executor.submit(self._prefetch, name)
+
+    def _prefetch(self, name: str):
+        # The lock is not held during the copy, so run, prefetch and report do not wait for it.
+        # The weights are in pageable memory, so the copy blocks this thread; the side stream only keeps it
+        # from queueing behind the inference kernels on the default stream.
+        try:
+            start = time.perf_counter()
+            if self.stream is not None:
+                with torch.cuda.stream(self.stream):
+                    self.models[name].to(self.device)
+                self.stream.synchronize()
+            else:
+                self.models[name].to(self.device)
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                stats = self.stats[name]
+                stats.transfer_seconds += elapsed
+                stats.loads += 1
+                stats.prefetches += 1
+        except BaseException:
+            with self.lock:
+                self.resident.discard(name)
+            raise
+        finally:
+            with self.lock:
+                self.busy[name] -= 1
+                self.pending.pop(name, None)
+
+    def _wait_prefetch(self, name: str):
+        with self.lock:
+            future = self.pending.get(name)
+        if future is not None:
+            future.result()
+
+    def _used(self) -> int:
+        return sum(self.stats[name].footprint for name in self.resident)
+
+    def evict_idle(self):
+        """
+        Parks every model that is not in use, to make room for a model the scheduler does not manage.
+        Does nothing with an unlimited budget.
+        """
+
+        with self.lock:
+            self._evict(math.inf)
+
+    def _make_resident(self, name: str, footprint: int):
+        if name in self.resident:
+            return
+        self._evict(footprint)
+        self._move(name, self.device)
+
+    def _evict(self, footprint: float):
+        victims = sorted((other for other in self.resident if self.busy[other] == 0),
+                         key=lambda other: (self.stats[other].uses, self.last_used[other]))
+        evicted = False
+        while self._used() + footprint > self.budget and victims:
+            self._move(victims.pop(0), self.parking_device)
+            evicted = True
+        if evicted:
+            gc.collect()
+            torch.cuda.empty_cache()
+
+    def _move(self, name: str, device: torch.device):
+        start = time.perf_counter()
+        self.models[name].to(device)
+        stats = self.stats[name]
+        stats.transfer_seconds += time.perf_counter() - start
+        if device == self.device:
+            self.resident.add(name)
+            stats.loads += 1
+        else:
+            self.resident.discard(name)
+            stats.evictions += 1
+
+    @staticmethod
+    def _device_of(model: torch.nn.Module) -> Optional[str]:
+        parameter = next(model.parameters(), None)
+        return parameter.device.type if parameter is not None else None
+
+    @property
+    def transfer_seconds(self) -> float:
+        return sum(stats.transfer_seconds for stats in self.stats.values())
+
+    def report(self) -> str:
+        lines = [f"Transfers took {self.transfer_seconds:.2f}s, "
+                 f"{self._used() / 2 ** 20:.0f} MB resident of {self.budget / 2 ** 20:.0f} MB budget"]
+        for name, stats in self.stats.items():
+            lines += [f"  {name}: {stats.footprint / 2 ** 20:.0f} MB, {stats.uses} uses, {stats.loads} loads "
+                      f"({stats.prefetches} prefetched), {stats.evictions} evictions, "
+                      f"{stats.transfer_seconds:.2f}s in transfers"]
+        return "\n".join(lines)
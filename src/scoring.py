@@ -0,0 +1,96 @@
+from dataclasses import dataclass
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+Segments = list[tuple[float, float, str]]
+
+
+def rasterize(segments: Segments, resolution: float, frames: int) -> tuple[list[str], np.ndarray]:
+    """
+    Turns segments into a (speakers, frames) 0/1 activity matrix, frame i covers [i, i + 1) * resolution.
+    Rows are contiguous, so per-speaker sums and the speaker overlap matrix are cheap BLAS calls.
+    """
+
+    labels = sorted({label for _, _, label in segments})
+    activity = np.zeros((len(labels), frames + 1), dtype=np.int32)
+    if len(segments) == 0:
+        return labels, activity[:, :-1].astype(np.float64)
+
+    index = {label: i for i, label in enumerate(labels)}
+    starts, ends, speakers = zip(*segments)
+    speakers = np.array([index[label] for label in speakers])
+    starts = np.clip(np.round(np.array(starts, dtype=np.float64) / resolution).astype(int), 0, frames)
+    ends = np.clip(np.round(np.array(ends, dtype=np.float64) / resolution).astype(int), 0, frames)
+
+    # Overlapping segments of one speaker just stack up, every positive count means "speaking"
+    np.add.at(activity, (speakers, starts), 1)
+    np.add.at(activity, (speakers, ends), -1)
+    return labels, (np.cumsum(activity, axis=1, dtype=np.int32)[:, :-1] > 0).astype(np.float64)
+
+
+@dataclass
+class DiarizationScore:
+    """
+    Error components in seconds, like pyannote's DiarizationErrorRate details.
+    """
+
+    total: float
+    miss: float
+    false_alarm: float
+    confusion: float
+    jer: float
+
+    def error_rate(self, miss: float = 1.0, false_alarm: float = 1.0, confusion: float = 1.0) -> float:
+        if self.total == 0:
+            return 0.0 if self.false_alarm == 0 else 1.0
+        return (miss * self.miss + false_alarm * self.false_alarm + confusion * self.confusion) / self.total
+
+    @property
+    def der(self) -> float:
+        return self.error_rate()
+
+
+def score_diarization(reference: Segments, hypothesis: Segments, resolution: float = 0.01) -> DiarizationScore:
+    """
+    DER components and JER computed on frames, speakers are mapped with the Hungarian algorithm
+    maximizing the overlap, as in pyannote.metrics.
+    """
+
+    end = max((end for _, end, _ in reference + hypothesis), default=0.0)
+    frames = int(np.ceil(end / resolution)) + 1
+    _, ref = rasterize(reference, resolution, frames)
+    _, hyp = rasterize(hypothesis, resolution, frames)
+
+    ref_count = np.ones(ref.shape[0]) @ ref
+    hyp_count = np.ones(hyp.shape[0]) @ hyp
+    cooccurrence = ref @ hyp.T
+    rows, cols = linear_sum_assignment(cooccurrence, maximize=True)
+    correct = cooccurrence[rows, cols].sum()
+
+    total = ref_count.sum()
+    miss = np.maximum(ref_count - hyp_count, 0).sum()
+    false_alarm = np.maximum(hyp_count - ref_count, 0).sum()
+    confusion = np.minimum(ref_count, hyp_count).sum() - correct
+
+    ref_duration = ref.sum(axis=1)
+    hyp_duration = hyp.sum(axis=1)
+    speaker_errors = np.ones(ref.shape[0])
+    intersection = cooccurrence[rows, cols]
+    union = ref_duration[rows] + hyp_duration[cols] - intersection
+    speaker_errors[rows] = 1 - intersection / np.maximum(union, 1)
+    jer = speaker_errors.mean() if len(speaker_errors) > 0 else 0.0
+
+    return DiarizationScore(float(total * resolution), float(miss * resolution),
+                            float(false_alarm * resolution), float(confusion * resolution), float(jer))
+
+
+def test_score_diarization():
+    reference = [(0.0, 10.0, "A"), (10.0, 20.0, "B")]
+    hypothesis = [(0.0, 10.0, "x"), (10.0, 15.0, "y"), (15.0, 20.0, "x"), (20.0, 22.0, "y")]
+    score = score_diarization(reference, hypothesis, resolution=0.5)
+    assert (score.total, score.miss, score.false_alarm, score.confusion) == (20.0, 0.0, 2.0, 5.0)
+    assert abs(score.der - 0.35) < 1e-9
+    assert abs(score.error_rate(miss=0.0) - 0.35) < 1e-9
+    # A: 10 / 15 overlap with x, B: 5 / 12 overlap with y
+    assert abs(score.jer - (1 - (10 / 15 + 5 / 12) / 2)) < 1e-9
@@ -1,4 +1,6 @@
-from yandex_cloud_ml_sdk import YCloudML
+from abc import ABC, abstractmethod
+from typing import Optional
+
 import os
 
 SYSTEM_PROMPT = """Ты - виртуальный помощник. Подведи итоги встречи, опиши, к чему пришли участники собрания.\
@@ -7,29 +9,155 @@ SYSTEM_PROMPT = """Ты - виртуальный помощник. Подвед
         и оставаться объективным и фактическим. Напиши ответ на русском языке."""
 
 
-class Summarizer:
+class Backend(ABC):
+    """
+    Completes (system prompt, user text) pairs.
+
+    The system prompt is shared by every call of a Summarizer, so its encoded form is kept
+    in a prompt-prefix cache and built only once per prompt.
+    """
+
+    def __init__(self, batch_size: int = 8):
+        self.batch_size = batch_size
+        self.prefixes = {}
+
+    def prefix(self, system_prompt: str):
+        if system_prompt not in self.prefixes:
+            self.prefixes[system_prompt] = self.encode_prefix(system_prompt)
+        return self.prefixes[system_prompt]
+
+    @abstractmethod
+    def encode_prefix(self, system_prompt: str):
+        pass
+
+    @abstractmethod
+    def run_batch(self, prefix, texts: list[str]) -> list[str]:
+        pass
+
+    def complete_batch(self, system_prompt: str, texts: list[str]) -> list[str]:
+        prefix = self.prefix(system_prompt)
+        result = []
+        for start in range(0, len(texts), self.batch_size):
+            result += self.run_batch(prefix, texts[start:start + self.batch_size])
+        return result
+
+    def complete(self, system_prompt: str, text: str) -> str:
+        return self.complete_batch(system_prompt, [text])[0]
+
+
+class YandexBackend(Backend):
     def __init__(self,
                  model="yandexgpt",
-                 folder_id=os.environ["YANDEX_FOLDER_ID"],
-                 api_key=os.environ["YANDEX_API_KEY"],
+                 folder_id: Optional[str] = None,
+                 api_key: Optional[str] = None,
                  temperature=0,
-                 system_prompt=SYSTEM_PROMPT):
-        self.sdk = YCloudML(folder_id=folder_id, auth=api_key)
+                 batch_size: int = 8):
+        super().__init__(batch_size)
+        from yandex_cloud_ml_sdk import YCloudML
+
+        self.sdk = YCloudML(folder_id=folder_id or os.environ["YANDEX_FOLDER_ID"],
+                            auth=api_key or os.environ["YANDEX_API_KEY"])
         self.model = self.sdk.models.completions(model, model_version="rc").configure(temperature=temperature)
+
+    def encode_prefix(self, system_prompt: str):
+        return {"role": "system", "text": system_prompt}
+
+    def run_batch(self, prefix, texts: list[str]) -> list[str]:
+        if len(texts) == 1:
+            # Interactive calls: the synchronous mode answers right away, deferred ones are polled
+            return [self.model.run([prefix, {"role": "user", "text": texts[0]}]).alternatives[0].text]
+        # Deferred requests are queued by the cloud together instead of waiting for each round-trip
+        operations = [self.model.run_deferred([prefix, {"role": "user", "text": text}]) for text in texts]
+        return [operation.wait().alternatives[0].text for operation in operations]
+
+
+class LlamaCppBackend(Backend):
+    """
+    Runs a local GGUF model on the CPU through llama.cpp (pip install llama-cpp-python).
+    """
+
+    def __init__(self,
+                 model_path: Optional[str] = None,
+                 temperature=0,
+                 n_ctx: int = 8192,
+                 n_threads: Optional[int] = None,
+                 max_tokens: int = 1024,
+                 cache_bytes: int = 2 << 30,
+                 batch_size: int = 8):
+        super().__init__(batch_size)
+        from llama_cpp import Llama, LlamaRAMCache
+
+        self.llm = Llama(model_path=model_path or os.environ["LLAMA_MODEL_PATH"],
+                         n_ctx=n_ctx,
+                         n_threads=n_threads,
+                         verbose=False)
+        # Keeps the KV state of evaluated prompts, calls sharing a system prompt only evaluate the transcript
+        self.llm.set_cache(LlamaRAMCache(capacity_bytes=cache_bytes))
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+
+    def encode_prefix(self, system_prompt: str):
+        prefix = {"role": "system", "content": system_prompt}
+        self.llm.create_chat_completion([prefix], max_tokens=1, temperature=self.temperature)
+        return prefix
+
+    def run_batch(self, prefix, texts: list[str]) -> list[str]:
+        return [self.llm.create_chat_completion([prefix, {"role": "user", "content": text}],
+                                                max_tokens=self.max_tokens,
+                                                temperature=self.temperature)["choices"][0]["message"]["content"]
+                for text in texts]
+
+
+class StubBackend(Backend):
+    """
+    Deterministic offline backend for tests and demos: answers with the first lines of the text.
+    """
+
+    def __init__(self, max_lines: int = 5, batch_size: int = 8):
+        super().__init__(batch_size)
+        self.max_lines = max_lines
+
+    def encode_prefix(self, system_prompt: str):
+        return system_prompt
+
+    def run_batch(self, prefix, texts: list[str]) -> list[str]:
+        return ["\n".join([line.strip() for line in text.splitlines() if line.strip()][:self.max_lines])
+                for text in texts]
+
+
+def make_backend(name: Optional[str] = None, **kwargs) -> Backend:
+    """
+    :param name: yandex, llama or stub, the SUMMARY_BACKEND env variable by default (yandex if it is not set)
+    """
+
+    name = name or os.environ.get("SUMMARY_BACKEND", "yandex")
+    match name:
+        case "yandex":
+            return YandexBackend(**kwargs)
+        case "llama":
+            return LlamaCppBackend(**kwargs)
+        case "stub":
+            return StubBackend(**kwargs)
+        case _:
+            raise RuntimeError(f"{name} is not supported.")
+
+
+class Summarizer:
+    def __init__(self,
+                 model="yandexgpt",
+                 folder_id: Optional[str] = None,
+                 api_key: Optional[str] = None,
+                 temperature=0,
+                 system_prompt=SYSTEM_PROMPT,
+                 backend: Optional[Backend] = None):
+        self.backend = backend or YandexBackend(model, folder_id, api_key, temperature)
         self.system_prompt = system_prompt
 
     def summarize(self, transcript):
-        messages = [
-            {
-                "role": "system",
-                "text": self.system_prompt
-            },
-            {
-                "role": "user",
-                "text": transcript
-            }
-        ]
-        return self.model.run(messages).alternatives[0].text.replace("\n\n", "\n")
+        return self.summarize_batch([transcript])[0]
+
+    def summarize_batch(self, transcripts: list[str]) -> list[str]:
+        return [text.replace("\n\n", "\n") for text in self.backend.complete_batch(self.system_prompt, transcripts)]
 
 
 def main():
@@ -59,7 +187,7 @@ def main():
 
         """
 
-    summarizer = Summarizer()
+    summarizer = Summarizer(backend=make_backend())
     print(summarizer.summarize(transcript))
 
 